@@ -2,23 +2,49 @@
 
 from PIL import Image
 import  numpy as np
-from itertools import product
-                # ufarray is used with the two pass connected component labeling
-import ufarray  # ufarray class from https://github.com/spwhitt/cclabel/blob/master/ufarray.py
-import copy
+                # ufarray is used with the run based connected component labeling
+import ufarray  # union find classes, UFarray from https://github.com/spwhitt/cclabel/blob/master/ufarray.py
 import logging
-from time import time
+import hashlib
+import os
+import tempfile
+import json
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, Counter, defaultdict, deque
+from functools import wraps
+from enum import IntEnum
+from time import time, perf_counter
 from random import random
 
 TOLERANCE = .02 # 20% needed for problem 6
 IMAGE_INTENSITY = 1  
 OBJECT_THRESHOLD = 20
-UNCHANGED_W = 0
-FILLED_W = 1
-ROTATED_W = 2
-DELETED_W = 10
-ADDED_W = 10
-FILLED_W = 3
+
+CACHE_SIZE = 20000  # number of comparison results kept between calls
+SHIFT_RADIUS = 1    # pixels a figure may slide along each axis in difference
+ALIGN_MODE = "shift" # "shift" tries SHIFT_RADIUS along each axis, "fft" finds the best 2-D
+                     # translation by cross-correlation, see fft_shift
+ALIGN_RADIUS = None  # pixels the "fft" mode may move a figure along each axis, None for any
+PYRAMID_LEVELS = 3   # halvings of each figure kept for coarse comparisons, 184 -> 92 -> 46 -> 23
+PYRAMID_MARGIN = 0   # how far a coarse bound must clear a threshold before the full comparison is
+                     # skipped, the bound is never over the full difference so 0 is already exact
+TENSOR_MODE = False # compute frame features for a whole problem at once, see ProblemTensor
+PRUNE_ANSWERS = True # only answers that can still win get transform checks and semantic nets
+PRUNE_MARGIN = None  # cheap score gap to the leader that drops an answer, None uses the most
+                     # the later stages could add, which never changes the answer
+PRUNE_TOP_K = None   # at most this many answers reach the later stages, None for no limit
+NODE_ASSIGNMENT = False # pair nodes in semantic nets by an optimal assignment instead of the
+                        # original greedy loops, see get_net. Changes some Basic D answers
+FIGURE_CACHE_DIR = ".figure_cache"    # decoded and labeled figures kept between runs, None turns it off
+FIGURE_CACHE_SIZE = 256 * 1024 * 1024 # bytes the figure cache may use before old entries are removed
+FIGURE_CACHE_VERSION = 1 # part of every figure cache key, raise it when labeling or the stored
+                         # arrays change so entries written by older code are not read
+PROFILE = False     # time the stages of each Solve and count the work done, see SolveStats
+PROFILE_MEMORY = False # trace allocations to find the peak memory of each Solve, slows solving
+PREFETCH = 0        # problems ahead whose figures are loaded in the background, 0 turns it off
+PREFETCH_THREADS = 2 # threads loading prefetched figures
 
 DB_LEVEL = "WARNING"
 
@@ -36,119 +62,712 @@ ch.setFormatter(formatter)
 
 logger.addHandler(ch)
 
+######################################################################
+#####    PROFILING
+#####
+######################################################################
+
+class SolveStats:
+    '''Timers and counters of one Solve call, kept on the problem as
+    problem.stats when PROFILE is set
+
+    Timers add up the seconds spent in each stage and how often it ran,
+    stages nest so a stage's time includes the stages it calls. Counters
+    count work such as difference() calls, pixel comparisons, node pairs,
+    threshold checks settled by the pyramid and cache hits'''
+
+    def __init__(self, problem=None):
+        self.problem = problem
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+        self.peak_memory = None
+
+    def add_time(self, name, seconds):
+        self.seconds[name] += seconds
+        self.calls[name] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def to_dict(self):
+        return {"problem": self.problem,
+                "timers": {i: {"seconds": self.seconds[i], "calls": self.calls[i]} for i in self.seconds},
+                "counters": {i: int(n) for i, n in self.counters.items()},
+                "peak_memory": self.peak_memory}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+class Profiling(threading.local):
+    '''The stats of the problem being solved on the current thread, None when
+    PROFILE is off so every hook costs one check. Work done on other threads,
+    such as prefetching, is not counted'''
+    stats = None
+
+profiling = Profiling()
+
+# Decorator timing every call of a function as the named stage
+def profiled(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            stats = profiling.stats
+            if stats is None:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.add_time(name, perf_counter() - start)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    if profiling.stats is not None:
+        profiling.stats.count(name, n)
+
 ######################################################################
 #####    COMPONENT LABELING
 #####
 ######################################################################
 
-# This is a two pass connected component labeling algorithm that I found open source on github
-# It seperates each figure into its component images, with each shape getting its own 'color'
-# Code copied from https://github.com/spwhitt/cclabel/blob/master/cclabel.py
-# I altered code slightly to fit problem
-# Algorithm obtained from "Optimizing Two-Pass Connected-Component Labeling 
-# by Kesheng Wu, Ekow Otoo, and Kenji Suzuki
+# Run based connected component labeling.
+# Rather than visiting every pixel, each row of the figure is broken into runs of
+# black pixels. Runs in neighbouring rows that touch are merged in one batch with
+# the numpy union find in ufarray, and each run is then painted with the label of
+# its component.
+# Labels are numbered 1..n in the order their first pixel appears when the figure
+# is scanned row by row, which is the same order the old two pass labeling gave.
 #
-def color_shapes(image):
-    output = np.zeros(image.shape)
-    width, height = image.shape
- 
-    # Union find data structure
-    uf = ufarray.UFarray() # UFarray code copied from https://github.com/spwhitt/cclabel/blob/master/ufarray.py
-    uf.makeLabel()
-    #
-    # First pass
-    #
- 
-    # Dictionary of point:label pairs
-    labels = {}
- 
-    for y, x in product(range(height), range(width)):
- 
-        # If the current pixel is 0, it's obviously not a component...
-        if image[x, y] == 0:
-            pass
- 
-        elif y > 0 and image[x, y-1] == 1:
-            labels[x, y] = labels[(x, y-1)]
+# connectivity is 8 (diagonal pixels touch) or 4 (only edge neighbours touch)
+#
+# Smallest unsigned type that holds every label
+def label_dtype(labels):
+    largest = int(labels.max()) if labels.size else 0
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if largest <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def find_runs(image):
+    '''Returns the row, start and end (exclusive) of every run of black pixels'''
+    height, width = image.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = image != 0
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    return rows, starts, ends
+
+def touching_runs(rows, starts, ends, width, connectivity=8):
+    '''Returns index pairs of runs in neighbouring rows that belong to the same shape'''
+    reach = 1 if connectivity == 8 else 0
+    stride = width + 2
+    run_starts = rows * stride + starts
+    run_ends = rows * stride + ends
+
+    # For every run, the runs in the row above that it touches form a contiguous
+    # range, because runs in a row are disjoint and sorted
+    above = (rows - 1) * stride
+    lo = np.searchsorted(run_ends, above + starts - reach, side="right")
+    hi = np.searchsorted(run_starts, above + ends + reach, side="left")
+    lo[rows == 0] = 0
+    hi[rows == 0] = 0
+    counts = np.maximum(hi - lo, 0)
+
+    below = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(lo, counts) + offsets, below
+
+@profiled("color_shapes")
+def color_shapes(image, connectivity=8):
+    # Figures are stored transposed, label them in the orientation of the png
+    pixels = image.T
+    height, width = pixels.shape
+
+    rows, starts, ends = find_runs(pixels)
+    if len(rows) == 0:
+        return np.zeros(pixels.shape, dtype=np.uint8).T
+
+    # Union find data structure, one element per run
+    uf = ufarray.UFnumpy(len(rows))
+    uf.makeLabels(len(rows))
+    uf.union_pairs(*touching_runs(rows, starts, ends, width, connectivity))
+
+    # Components are numbered 1..n in order of their first run, and stored in
+    # the smallest type that holds n
+    labels = uf.flatten()
+    output = np.zeros(pixels.shape, dtype=label_dtype(labels))
+
+    # Paint each run with its label
+    lengths = ends - starts
+    run_of_pixel = np.repeat(np.arange(len(rows)), lengths)
+    columns = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    output[rows[run_of_pixel], starts[run_of_pixel] + columns] = labels[run_of_pixel]
+
+    return output.T
+
+
+
+######################################################################
+#####    IMAGE PROCESSING METHODS
+#####
+######################################################################
+
+@profiled("to_image_array")
+def to_image_array(filename):
+    image = Image.open(filename).convert("L") #opens image, converts to single channel grayscale
+    # Dark pixels are black, thresholded straight from the 8 bit grayscale
+    return np.asarray(image).T <= 128
+
+# Finds every labeled shape in one sweep over the label image
+# Returns a list with (area, bbox, mask) for labels 1..n, where bbox is
+# (x0, y0, x1, y1) with exclusive ends and mask is the bool crop of the bbox
+@profiled("extract_components")
+def extract_components(labels):
+    flat = labels.reshape(-1)
+    count = int(flat.max()) + 1 if flat.size else 1
+    height = labels.shape[1]
+
+    index = np.flatnonzero(flat)
+    label = flat[index].astype(np.intp)
+    x = index // height
+    y = index % height
+
+    area = np.bincount(label, minlength=count)
+    present = area > 0
+
+    # Pixels grouped by label, so each bbox is a reduction over one segment
+    order = np.argsort(label, kind="stable")
+    bounds = np.cumsum(area[1:])[:-1]
+    x_groups = np.split(x[order], bounds)
+    y_groups = np.split(y[order], bounds)
+
+    components = []
+    for i in range(1, count):
+        if not present[i]:
+            components.append((0, (0, 0, 0, 0), np.zeros((0, 0), dtype=bool)))
+            continue
+        xs = x_groups[i - 1]
+        ys = y_groups[i - 1]
+        x0, x1 = int(xs.min()), int(xs.max()) + 1
+        y0, y1 = int(ys.min()), int(ys.max()) + 1
+        mask = np.zeros((x1 - x0, y1 - y0), dtype=bool)
+        mask[xs - x0, ys - y0] = True
+        components.append((int(area[i]), (x0, y0, x1, y1), mask))
+    return components
 
-        elif x+1 < width and y > 0 and image[x+1, y-1] == 1:
- 
-            c = labels[(x+1, y-1)]
-            labels[x, y] = c
 
-            if x > 0 and image[x-1, y-1] == 1:
-                a = labels[(x-1, y-1)]
-                uf.union(c, a)
- 
-            elif x > 0 and image[x-1, y] == 1:
-                d = labels[(x-1, y)]
-                uf.union(c, d)
 
-        elif x > 0 and y > 0 and image[x-1, y-1] == 1:
-            labels[x, y] = labels[(x-1, y-1)]
+######################################################################
+#####    FIGURE CACHE
+#####
+######################################################################
+
+class FigureCache:
+    '''Decoded and labeled figures saved on disk between runs
+
+    Each png is stored as an .npz holding its label map, named after a hash of
+    FIGURE_CACHE_VERSION and the file's path, modification time and contents.
+    Entries are removed least recently used first once the cache grows past
+    size bytes. Several processes may share the directory, so any entry can
+    disappear at any time.'''
+
+    def __init__(self, directory=FIGURE_CACHE_DIR, size=FIGURE_CACHE_SIZE):
+        self.directory = directory
+        self.size = size
+        self._entries = None
+        self.lock = threading.Lock() # figures may be loaded and stored from prefetch threads
+
+    def key(self, filename):
+        with open(filename, "rb") as f:
+            content = hashlib.sha1(f.read()).hexdigest()
+        stamp = "%d|%s|%d|%s" % (FIGURE_CACHE_VERSION, os.path.abspath(filename),
+                                 os.stat(filename).st_mtime_ns, content)
+        return hashlib.sha1(stamp.encode("utf-8")).hexdigest()
+
+    # name -> [bytes, last use] for every file in the cache, read once
+    def entries(self):
+        if self._entries is None:
+            self._entries = {}
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if not name.endswith(".npz"):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(self.directory, name))
+                    except OSError:
+                        continue
+                    self._entries[name] = [stat.st_size, stat.st_mtime]
+        return self._entries
+
+    # Returns the label map of the figure, or None if it is not cached
+    def load(self, filename):
+        name = self.key(filename) + ".npz"
+        path = os.path.join(self.directory, name)
+        try:
+            with np.load(path) as data:
+                labels = data["labels"]
+            os.utime(path)
+            size = os.path.getsize(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        with self.lock:
+            self.entries()[name] = [size, time()]
+        return labels
+
+    def store(self, filename, labels):
+        os.makedirs(self.directory, exist_ok=True)
+        name = self.key(filename) + ".npz"
+
+        # Written to a temporary file first so readers never see half an entry
+        handle, temporary = tempfile.mkstemp(suffix=".npz", dir=self.directory)
+        with os.fdopen(handle, "wb") as f:
+            np.savez_compressed(f, labels=labels.astype(label_dtype(labels), copy=False))
+            f.flush()
+            size = os.fstat(f.fileno()).st_size
+        os.replace(temporary, os.path.join(self.directory, name))
+
+        with self.lock:
+            self.entries()[name] = [size, time()]
+            self.evict()
+
+    # Called with the lock held
+    def evict(self):
+        entries = self.entries()
+        total = sum(i[0] for i in entries.values())
+        for name in sorted(entries, key=lambda i: entries[i][1]):
+            if total <= self.size:
+                break
+            total -= entries.pop(name)[0]
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
 
-        elif x > 0 and image[x-1, y] == 1:
-            labels[x, y] = labels[(x-1, y)]
- 
-        else: 
-            labels[x, y] = uf.makeLabel()
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".npz"):
+                    os.remove(os.path.join(self.directory, name))
+        self._entries = {}
 
-    uf.flatten()
+figure_cache = FigureCache() if FIGURE_CACHE_DIR else None
 
-    for (i, j) in labels:
+# The label map of a figure and whether it came from the figure cache. Figures
+# not in the cache are decoded, labeled and stored
+def load_labels(filename):
+    labels = figure_cache.load(filename) if figure_cache else None
+    if labels is not None:
+        return labels, True
+    labels = color_shapes(to_image_array(filename))
+    if figure_cache:
+        figure_cache.store(filename, labels)
+    return labels, False
 
-        # Name of the label the current point belongs to
-        label = uf.find(labels[(i, j)])
-        output[i, j] = label
 
-    return output
+######################################################################
+#####    PREFETCHING
+#####
+######################################################################
 
-######## END COPIED CODE ###########
+# Yields problems in order while the figures of the next depth problems are
+# loaded on a pool of threads, so their images are ready when Solve reaches
+# them. Decoding and labeling spend most of their time in PIL and numpy,
+# which let other threads run. Each figure's pending labels are left in
+# figure.attr["Labels"] for create_nodes
+def prefetch(problems, depth=None, threads=None):
+    depth = PREFETCH if depth is None else depth
+    threads = PREFETCH_THREADS if threads is None else threads
+    if depth <= 0:
+        yield from problems
+        return
+
+    with ThreadPoolExecutor(threads) as pool:
+        queue = deque()
+        for problem in problems:
+            for figure in problem.figures.values():
+                figure.attr = {"Labels": pool.submit(load_labels, figure.visualFilename)}
+            queue.append(problem)
+            if len(queue) > depth:
+                yield queue.popleft()
+        while queue:
+            yield queue.popleft()
 
 
 ######################################################################
-#####    IMAGE PROCESSING METHODS
+#####    BITMAPS
 #####
 ######################################################################
 
-def to_image_array(filename):
-    image = Image.open(filename).convert("L") #opens image, converts to single channel grayscale
-    im_data = np.asarray(image, dtype=np.int32).T
-    binary = np.zeros(im_data.shape)
-    binary[np.where(im_data <= 128)] = 1 
-    binary[np.where(im_data > 128)] = 0
+# Number of black pixels in each byte of an array of packed bits
+if hasattr(np, "bitwise_count"):
+    def bit_counts(bits, out=None):
+        return np.bitwise_count(bits, out=out)
+else:
+    BIT_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def bit_counts(bits, out=None):
+        return np.take(BIT_COUNTS, bits, out=out)
+
+# Number of black pixels in an array of packed bits
+# popcount_inplace overwrites bits with the count of each byte
+def popcount_inplace(bits):
+    return int(bit_counts(bits, bits).sum(dtype=np.int64))
+
+def popcount(bits):
+    return popcount_inplace(bits.copy())
+
+# Counts of blocks along an axis, and the counts grown by the pixels of the
+# neighbouring blocks within reach, given the pixels at the head and the tail of
+# every block, wrapping around like np.roll
+def grow_blocks(counts, heads, tails, axis):
+    counts = counts.astype(np.int32)
+    grown = counts.copy()
+    if axis:
+        grown, heads, tails = grown.T, heads.T, tails.T
+    grown[1:] += tails[:-1]
+    grown[0] += tails[-1]
+    grown[:-1] += heads[1:]
+    grown[-1] += heads[0]
+    return counts, grown.T if axis else grown
+
+# Number of black pixels in each bitmap of a stack of packed rows
+def popcount_each(bits):
+    return bit_counts(bits).sum(axis=(-2, -1), dtype=np.int64)
+
+# Reused output buffers for xor_popcount, one per slice shape
+scratch_buffers = {}
+
+# Number of bits that differ between two packed arrays, without allocating
+def xor_popcount(x, y):
+    scratch = scratch_buffers.get(x.shape)
+    if scratch is None:
+        scratch = scratch_buffers[x.shape] = np.empty(x.shape, dtype=np.uint8)
+    np.bitwise_xor(x, y, out=scratch)
+    return popcount_inplace(scratch)
+
+# The eight rotations and flips of a square figure
+D4_TRANSFORMS = {
+    "IDENTITY": lambda p: p,
+    "ROTATED_90": lambda p: np.rot90(p, 1),
+    "ROTATED_180": lambda p: np.rot90(p, 2),
+    "ROTATED_270": lambda p: np.rot90(p, 3),
+    "FLIP_UD": np.flipud,
+    "FLIP_LR": np.fliplr,
+    "TRANSPOSE": lambda p: p.T,
+    "ANTI_TRANSPOSE": lambda p: np.rot90(p, 2).T,
+}
+
+class Bitmap:
+    '''A black and white figure packed 8 pixels to a byte
+
+    The bits are kept twice, packed along each axis, so shifting the figure by a
+    pixel along either axis only moves whole rows of bytes.
+
+    A Bitmap also serves as the descriptor of its figure, the rotated and
+    flipped variants and the coarse pyramid are made the first time they are
+    needed and kept'''
+
+    def __init__(self, pixels):
+        pixels = np.asarray(pixels) != 0
+        self.shape = pixels.shape
+        self.size = pixels.size
+        self.rows = np.packbits(pixels, axis=1)
+        self.cols = np.packbits(pixels.T, axis=1)
+        self.count = popcount(self.rows)
+
+        # Content hash, equal bitmaps share cached comparison results
+        self.key = hashlib.blake2b(self.rows.tobytes(), digest_size=16).digest() + bytes(str(self.shape), "ascii")
+
+        self._variants = {"IDENTITY": self}
+        self._spectrum = None
+        self._pyramids = {}
+
+    def unpack(self):
+        return np.unpackbits(self.rows, axis=1, count=self.shape[1]).astype(bool)
+
+    # The figure under one of the D4_TRANSFORMS
+    def transformed(self, name):
+        if name not in self._variants:
+            self._variants[name] = Bitmap(D4_TRANSFORMS[name](self.unpack()))
+        return self._variants[name]
+
+    # Real 2-D Fourier transform of the pixels, made once for fft_shift
+    @property
+    def spectrum(self):
+        if self._spectrum is None:
+            self._spectrum = np.fft.rfft2(self.unpack().astype(float))
+        return self._spectrum
+
+    # Black pixel counts of the blocks of 2 ** (level + 1) pixels square, for
+    # level up to PYRAMID_LEVELS, and the counts of each block grown by radius
+    # pixels on every side, wrapping around the edges like np.roll. Blocks
+    # line up with the packed bytes, so the counts come from the bytes without
+    # unpacking. None when the figure does not split evenly into blocks. The
+    # radius is SHIFT_RADIUS when not given
+    def pyramid(self, level, radius=None):
+        if radius is None:
+            radius = SHIFT_RADIUS
+        if (level, radius) not in self._pyramids:
+            width = 2 ** (level + 1)
+            if width > 8 or radius > width or self.shape[0] % width or self.shape[1] % 8:
+                self._pyramids[level, radius] = None
+                return None
+            # Every byte holds 8 // width groups of width pixels, first pixel highest
+            groups = [(self.rows >> (8 - (g + 1) * width)) & (2 ** width - 1) for g in range(8 // width)]
+            groups = np.stack(groups, axis=-1).reshape(self.shape[0], -1)
+            counts, grown = grow_blocks(bit_counts(groups), bit_counts(groups >> (width - radius)),
+                                        bit_counts(groups & (2 ** radius - 1)), 1)
+            # Then the rows of every block, and of its neighbours within reach
+            counts = counts.reshape(-1, width, counts.shape[1]).sum(axis=1)
+            grown = grown.reshape(-1, width, grown.shape[1])
+            grown = grow_blocks(grown.sum(axis=1), grown[:, :radius].sum(axis=1),
+                                grown[:, width - radius:].sum(axis=1), 0)[1]
+            self._pyramids[level, radius] = (counts, grown)
+        return self._pyramids[level, radius]
+
+    def flipud(self):
+        return self.transformed("FLIP_UD")
+
+    def fliplr(self):
+        return self.transformed("FLIP_LR")
+
+    def rot90(self, k=1):
+        return self.transformed("ROTATED_" + str(k % 4 * 90)) if k % 4 else self
+
+    # Pixels that differ between two bitmaps after this one is rolled by shift
+    # pixels along axis like np.roll. The rolled figure is never built, the
+    # overlapping rows and the rows that wrap around are compared in place
+    def xor_count(self, other, shift=0, axis=0):
+        if axis == 0:
+            mine, theirs = self.rows, other.rows
+        else:
+            mine, theirs = self.cols, other.cols
+        shift %= len(mine)
+        if shift == 0:
+            return xor_popcount(mine, theirs)
+        return xor_popcount(mine[:-shift], theirs[shift:]) + xor_popcount(mine[-shift:], theirs[:shift])
 
-    return binary
+    def __and__(self, other):
+        return Bitmap.from_packed(self.rows & other.rows, self.shape)
 
+    def __or__(self, other):
+        return Bitmap.from_packed(self.rows | other.rows, self.shape)
+
+    def __xor__(self, other):
+        return Bitmap.from_packed(self.rows ^ other.rows, self.shape)
+
+    @staticmethod
+    def from_packed(rows, shape):
+        return Bitmap(np.unpackbits(rows, axis=1, count=shape[1]))
 
 
 ######################################################################
-#####    OBJECT COMPARISON METHODS
+#####    COMPARISON CACHE
 #####
 ######################################################################
 
-def difference(a, b):
-    if np.sum(a) != 0:
-        diff = (np.sum(abs(a - b))) / np.sum(a)
-
-        rolls = [np.roll(a, 1, 0), np.roll(a, -1, 0), np.roll(a, 1, 1), np.roll(a, -1, 1)]
+class ResultCache:
+    '''Least recently used store of comparison results, keyed by the
+    operation and the content hashes of the bitmaps compared'''
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key in self.results:
+            self.results.move_to_end(key)
+            self.hits += 1
+            return True, self.results[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        self.results[key] = value
+        self.results.move_to_end(key)
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, size):
+        self.size = size
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.results.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.results), "size": self.size}
+
+# Shared by every Frame, so a pair compared in one frame is free in the next
+comparison_cache = ResultCache()
+
+# The settings every comparison depends on. They are part of each
+# comparison_cache key, so results cached under one alignment are not
+# returned after ALIGN_MODE, ALIGN_RADIUS or SHIFT_RADIUS change
+def alignment_key():
+    return (ALIGN_MODE, ALIGN_RADIUS, SHIFT_RADIUS)
+
+# Decorator for comparisons of two bitmaps, results are looked up by content
+# and alignment_key
+def cached(function):
+    @wraps(function)
+    def wrapper(a, b, *args):
+        key = (function.__name__, a.key, b.key) + args + alignment_key()
+        found, result = comparison_cache.get(key)
+        if not found:
+            result = function(a, b, *args)
+            comparison_cache.put(key, result)
+        return result
+    return wrapper
 
-        diffs = [(np.sum(abs(i - b))) / np.sum(i) for i in rolls ]
 
-        # logger.debug("Diff: " + str(diff))
-        # logger.debug("Rolls: " + str(diffs))
-        for i in diffs:
-            if i < diff:
-                # logger.debug("Original Diff: " + str(diff) + " Post Roll diff: " + str(i))
-                diff = i  
+######################################################################
+#####    OBJECT COMPARISON METHODS
+#####
+######################################################################
 
-        return diff
-    else:
-        return np.sum(b) / b.size
+# Offsets tried by the shift tolerant comparison, as (x, y), in the order they
+# are tried, the unshifted figure first then one pixel at a time along each axis
+def shift_offsets(radius):
+    offsets = [(0, 0)]
+    for i in range(1, radius + 1):
+        offsets += [(i, 0), (-i, 0), (0, i), (0, -i)]
+    return offsets
+
+# Finds the offset of a, within radius pixels along either axis, that best
+# matches b. Returns the difference score and that offset, the first offset
+# tried wins a tie. radius is SHIFT_RADIUS when not given
+@cached
+def best_shift(a, b, radius=None):
+    if radius is None:
+        radius = SHIFT_RADIUS
+    if a.count == 0:
+        return b.count / b.size, (0, 0)
+
+    diff, best = None, None
+    count("pixel comparisons", len(shift_offsets(radius)))
+    for offset in shift_offsets(radius):
+        if offset[0]:
+            mismatch = a.xor_count(b, offset[0], 0)
+        else:
+            mismatch = a.xor_count(b, offset[1], 1)
+        if diff is None or mismatch / a.count < diff:
+            diff, best = mismatch / a.count, offset
+    return diff, best
+
+# Penalty added to the mismatch at every offset of a figure of the given shape,
+# below one pixel and growing with the distance moved so the smallest move
+# wins a tie, infinite past radius pixels along either axis
+alignment_penalties = {}
+
+def alignment_penalty(shape, radius):
+    if (shape, radius) not in alignment_penalties:
+        x = np.minimum(np.arange(shape[0]), shape[0] - np.arange(shape[0]))[:, None]
+        y = np.minimum(np.arange(shape[1]), shape[1] - np.arange(shape[1]))[None, :]
+        penalty = (x + y) / (shape[0] + shape[1] + 1.0)
+        if radius is not None:
+            penalty = np.where((x <= radius) & (y <= radius), penalty, np.inf)
+        alignment_penalties[shape, radius] = penalty
+    return alignment_penalties[shape, radius]
+
+# The difference of each a against the b at the same place in the lists, with
+# a moved by the best 2-D translation within radius. The overlap of a rolled
+# by every offset with b is one cross-correlation, computed in O(N log N) from
+# the spectra of the two figures. A radius of None allows any translation.
+# Returns the differences and the offsets
+def fft_differences(a, b, radius):
+    shape = b[0].shape
+    count("pixel comparisons", len(a))
+    a_counts = np.array([i.count for i in a], dtype=float)
+    b_counts = np.array([i.count for i in b], dtype=float)
+    spectra = np.conj(np.stack([i.spectrum for i in a])) * np.stack([i.spectrum for i in b])
+    overlap = np.rint(np.fft.irfft2(spectra, s=shape))
+    mismatch = a_counts[:, None, None] + b_counts[:, None, None] - 2 * overlap
+
+    best = (mismatch + alignment_penalty(shape, radius)).reshape(len(a), -1).argmin(axis=1)
+    x, y = np.unravel_index(best, shape)
+    mismatch = mismatch[np.arange(len(a)), x, y]
+    x = np.where(x > shape[0] // 2, x - shape[0], x)
+    y = np.where(y > shape[1] // 2, y - shape[1], y)
+
+    empty = a_counts == 0
+    diffs = np.where(empty, b_counts / b[0].size, mismatch / np.where(empty, 1, a_counts))
+    offsets = [(0, 0) if e else (int(i), int(j)) for e, i, j in zip(empty, x, y)]
+    return diffs, offsets
+
+# Like best_shift, but a may move by any translation within radius pixels
+# along both axes at once, or any translation at all when radius is None
+@cached
+def fft_shift(a, b, radius):
+    diffs, offsets = fft_differences([a], [b], radius)
+    return float(diffs[0]), offsets[0]
+
+# a and b are Bitmaps, the difference is the share of a's pixels that do not
+# match b, allowing a to slide up to radius pixels along either axis,
+# SHIFT_RADIUS when not given. The radius is read on every call so that
+# cached results are kept apart by radius. With ALIGN_MODE "fft" a may move
+# by any translation within ALIGN_RADIUS instead
+def difference(a, b, radius=None):
+    count("difference calls")
+    if ALIGN_MODE == "fft":
+        return fft_shift(a, b, ALIGN_RADIUS)[0]
+    if radius is None:
+        radius = SHIFT_RADIUS
+    return best_shift(a, b, radius)[0]
+
+# A lower bound on difference(a, b) from one level of the pyramids. However a
+# moves within radius, its pixels in a block can only meet pixels of b in the
+# grown block, so any more than b has there are a mismatch, and the same for
+# the pixels of b in a block against the grown block of a. The radius is
+# SHIFT_RADIUS when not given
+def coarse_difference(a, b, level, radius=None):
+    if radius is None:
+        radius = SHIFT_RADIUS
+    a_blocks, a_grown = a.pyramid(level, radius)
+    b_blocks, b_grown = b.pyramid(level, radius)
+    mismatch = np.maximum(a_blocks - b_grown, 0).sum() + np.maximum(b_blocks - a_grown, 0).sum()
+    return mismatch / a.count
+
+# Whether difference(a, b) is below threshold, or at most threshold when
+# inclusive. The pyramid is walked from the top, where the whole figure is one
+# block and the bound is the difference of the pixel counts, down to the finest
+# level, and the figures are only compared in full when no bound is over the
+# threshold
+def below_threshold(a, b, threshold, inclusive=False):
+    radius = ALIGN_RADIUS if ALIGN_MODE == "fft" else SHIFT_RADIUS
+    if a.count and abs(a.count - b.count) / a.count > threshold + PYRAMID_MARGIN:
+        count("coarse rejections")
+        return False
+    if a.count and radius is not None:
+        for level in reversed(range(PYRAMID_LEVELS)):
+            if a.pyramid(level, radius) is None or b.pyramid(level, radius) is None:
+                break
+            if coarse_difference(a, b, level, radius) > threshold + PYRAMID_MARGIN:
+                count("coarse rejections")
+                return False
+    count("full threshold checks")
+    diff = difference(a, b)
+    return diff <= threshold if inclusive else diff < threshold
 
+@cached
 def object_flipud(a, b):
+    tmp = a.flipud()
+    if not below_threshold(tmp, b, TOLERANCE):
+        return -1
     pre_diff = difference(a,b)
-    tmp = np.flipud(a)
     post_diff = difference(tmp, b)
     if abs(pre_diff - post_diff) < TOLERANCE:
         return -1
@@ -157,9 +776,12 @@ def object_flipud(a, b):
     else:
         return -1
 
+@cached
 def object_fliplr(a, b):
+    tmp = a.fliplr()
+    if not below_threshold(tmp, b, TOLERANCE):
+        return -1
     pre_diff = difference(a,b)
-    tmp = np.fliplr(a)
     post_diff = difference(tmp, b)
     if abs(pre_diff - post_diff) < TOLERANCE:
         return -1
@@ -168,23 +790,18 @@ def object_fliplr(a, b):
     else:
         return -1
 
+@cached
 def object_unchanged(a, b, tol=TOLERANCE):
-    diff = difference(a, b)
-    # logger.debug("Original Diff is " + str(a.name) + " " + str(b.name) + " difference is " + str(diff))
- 
-    if diff <= tol:
-        if diff > 0.03:
-            # logger.warning("Shapes the same with difference: " + str(diff))
-            pass
+    if below_threshold(a, b, tol, inclusive=True):
         return "UNCHANGED"
     else:
         return -1
 
+@cached
 def object_rotated(a, b):
-    c = copy.copy(a)
     pre_diff = difference(a,b)
     for i in range(1,4):
-        c = np.rot90(c)
+        c = a.rot90(i)
         post_diff = difference(c, b)      
         if abs(pre_diff - post_diff) > 0.05:
             if i == 3:
@@ -193,144 +810,441 @@ def object_rotated(a, b):
                 return str("ROTATED_" + str(i *90))
     return -1
 
+######################################################################
+#####    PROBLEM TENSOR
+#####
+######################################################################
+
+# The shift tolerant difference of whole stacks of bitmaps at once
+# a_* and b_* are packed rows, packed columns and pixel counts that broadcast
+# against each other, with the figure rows on the second to last axis. radius
+# is SHIFT_RADIUS when not given
+def batch_difference(a_rows, a_cols, a_counts, b_rows, b_cols, b_counts, size, radius=None):
+    if radius is None:
+        radius = SHIFT_RADIUS
+    count("pixel comparisons", np.broadcast(a_counts, b_counts).size * len(shift_offsets(radius)))
+    best = None
+    for x, y in shift_offsets(radius):
+        if x:
+            mismatch = popcount_each(np.roll(a_rows, x, -2) ^ b_rows)
+        else:
+            mismatch = popcount_each(np.roll(a_cols, y, -2) ^ b_cols)
+        best = mismatch if best is None else np.minimum(best, mismatch)
+    empty = a_counts == 0
+    return np.where(empty, b_counts / size, best / np.where(empty, 1, a_counts))
+
+class ProblemTensor:
+    '''Every figure of a problem stacked into one (N, H, W/8) array of packed bits
+
+    Differences are computed for every pair of figures in one pass, and AND, OR
+    and XOR of a pair are checked against every other figure in one pass, the
+    Frames of the problem only look the results up'''
+
+    def __init__(self, figures):
+        self.names = sorted(figures)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        bitmaps = [figures[name].attr["Bitmap"] for name in self.names]
+        self.bitmaps = bitmaps
+        self.rows = np.stack([i.rows for i in bitmaps])
+        self.cols = np.stack([i.cols for i in bitmaps])
+        self.counts = np.array([i.count for i in bitmaps])
+        self.size = bitmaps[0].size
+        self._differences = None
+        self._operators = {}
+
+    # difference() of every figure against every other, as an (N, N) array
+    def differences(self):
+        if self._differences is None and ALIGN_MODE == "fft":
+            self._differences = np.array([fft_differences([i] * len(self.bitmaps), self.bitmaps, ALIGN_RADIUS)[0]
+                                          for i in self.bitmaps])
+        elif self._differences is None:
+            self._differences = batch_difference(
+                self.rows[:, None], self.cols[:, None], self.counts[:, None],
+                self.rows[None, :], self.cols[None, :], self.counts[None, :], self.size)
+        return self._differences
+
+    def difference(self, a, b):
+        return float(self.differences()[self.index[a.name], self.index[b.name]])
+
+    # Name of the first of AND, OR and XOR of a and b that matches c, or "none"
+    def and_or_xor(self, a, b, c):
+        pair = (self.index[a.name], self.index[b.name])
+        if pair not in self._operators:
+            i, j = pair
+            results = []
+            for operator in (np.bitwise_and, np.bitwise_or, np.bitwise_xor):
+                rows = operator(self.rows[i], self.rows[j])
+                if ALIGN_MODE == "fft":
+                    combined = Bitmap.from_packed(rows, self.bitmaps[i].shape)
+                    results.append(fft_differences([combined] * len(self.bitmaps), self.bitmaps, ALIGN_RADIUS)[0] < TOLERANCE)
+                    continue
+                cols = operator(self.cols[i], self.cols[j])
+                results.append(batch_difference(rows, cols, popcount_each(rows),
+                                                 self.rows, self.cols, self.counts, self.size) < TOLERANCE)
+            self._operators[pair] = results
+        k = self.index[c.name]
+        for name, matches in zip(("AND", "OR", "XOR"), self._operators[pair]):
+            if matches[k]:
+                return name
+        return "none"
+
+
+######################################################################
+#####    NODE CORRESPONDENCE
+#####
+######################################################################
+
+# Relations a node can have to its match, cheapest first, see node_relations
+RELATION_COSTS = {"UNCHANGED": 0, "ROTATED_90": 1, "ROTATED_180": 1, "ROTATED_270": 1,
+                  "FLIP_LR": 2, "FLIP_UD": 2}
+NO_MATCH_COST = 4
+
+def linear_assignment(cost):
+    '''Rows and columns of the cheapest one to one matching in a cost matrix,
+    found with the Hungarian method. Every row (or column, when there are
+    fewer) is matched'''
+    cost = np.asarray(cost, dtype=float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+
+    # Potentials of rows and columns, and the row matched to each column, all
+    # counted from 1 so that column 0 can stand for the row being added
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            reduced = cost[p[j0] - 1] - u[p[j0]] - v[1:]
+            free = ~used[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+
+        # Flip the augmenting path
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    cols = np.flatnonzero(p[1:]) 
+    rows = p[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+# Where the bounding box (x0, y0, x1, y1) of a shape in a figure of the given
+# shape ends up under one of the D4_TRANSFORMS
+def transform_box(box, name, shape):
+    x0, y0, x1, y1 = box
+    X, Y = shape
+    return {
+        "IDENTITY": (x0, y0, x1, y1),
+        "ROTATED_90": (Y - y1, x0, Y - y0, x1),
+        "ROTATED_180": (X - x1, Y - y1, X - x0, Y - y0),
+        "ROTATED_270": (y0, X - x1, y1, X - x0),
+        "FLIP_UD": (X - x1, y0, X - x0, y1),
+        "FLIP_LR": (x0, Y - y1, x1, Y - y0),
+        "TRANSPOSE": (y0, x0, y1, x1),
+        "ANTI_TRANSPOSE": (Y - y1, X - x1, Y - y0, X - x0),
+    }[name]
+
+class NodeTable:
+    '''The nodes of one figure kept in arrays, one row per node, built once
+    when the figure is loaded. Indexing or iterating gives Node objects, which
+    are small views of one row
+
+    The areas and bounding boxes find the node pairs worth comparing pixel by
+    pixel. Two shapes can only be related if their areas are within 5%, and a
+    difference below 1 needs the shapes to overlap once moved by up to
+    SHIFT_RADIUS pixels, or ALIGN_RADIUS in the "fft" ALIGN_MODE. Pairs that
+    fail either test get the difference of shapes that do not touch without
+    any pixels being compared.'''
+
+    # components are the (label, bbox, mask) of each node, shape is the size
+    # of the figure
+    def __init__(self, components, shape):
+        self.shape = shape
+        self.labels = np.array([i[0] for i in components], dtype=np.int32)
+        self.boxes = np.array([i[1] for i in components], dtype=int).reshape(-1, 4)
+        self.masks = [i[2] for i in components]
+        self.areas = np.array([np.count_nonzero(i) for i in self.masks], dtype=float)
+        self.bitmaps = [None] * len(self.masks)
+        self.nodes = [Node(self, i) for i in range(len(self.masks))]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __getitem__(self, i):
+        return self.nodes[i]
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    # Pairs whose areas are close enough for any of the object_* relations
+    def same_size(self, other):
+        ratio = self.areas[:, None] / other.areas[None, :]
+        return (0.95 < ratio) & (ratio < 1.05)
+
+    # Pairs where the node of self, under transform name, comes within
+    # SHIFT_RADIUS, or ALIGN_RADIUS in "fft" mode, of the node of other. A box
+    # that would roll past the edge of the figure wraps around, so it counts
+    # as near along that axis
+    def near(self, other, name):
+        radius = ALIGN_RADIUS if ALIGN_MODE == "fft" else SHIFT_RADIUS
+        if radius is None:
+            return np.ones((len(self.boxes), len(other.boxes)), dtype=bool)
+        boxes = np.array([transform_box(i, name, self.shape) for i in self.boxes], dtype=int).reshape(-1, 4)
+        shape = transform_box((0, 0) + tuple(self.shape), name, self.shape)[2:]
+        near = np.ones((len(boxes), len(other.boxes)), dtype=bool)
+        for axis in range(2):
+            low = boxes[:, axis, None] - radius
+            high = boxes[:, axis + 2, None] + radius
+            wraps = (low < 0) | (high > shape[axis])
+            near &= wraps | ((low < other.boxes[None, :, axis + 2]) & (other.boxes[None, :, axis] < high))
+        return near
+
+    # The difference of every pair of nodes that do not touch
+    def apart(self, other):
+        return (self.areas[:, None] + other.areas[None, :]) / self.areas[:, None]
+
+# Packed rows, packed columns and pixel counts of a list of bitmaps
+def stack_bitmaps(bitmaps):
+    return (np.stack([i.rows for i in bitmaps]), np.stack([i.cols for i in bitmaps]),
+            np.array([i.count for i in bitmaps]))
+
+# The relation object_unchanged, object_rotated, object_fliplr and
+# object_flipud find between every node of NodeTable a and every node of b,
+# checked in that order, "no match" when there is none or the areas differ by
+# 5% or more. Also returns the unshifted difference of every pair. Pairs set
+# in skip are left as "no match" without comparing pixels
+def relation_matrix(a, b, skip=None):
+    same_size = a.same_size(b)
+    if skip is not None:
+        same_size &= ~skip
+    apart = a.apart(b)
+    size = b[0].bitmap.size
+
+    # Only pairs the node tables find near each other have their pixels compared
+    def differences(name):
+        result = apart.copy()
+        i, j = np.nonzero(same_size & a.near(b, name))
+        count("node pairs compared", len(i))
+        if len(i) and ALIGN_MODE == "fft":
+            a_bitmaps = [a[k].bitmap.transformed(name) for k in i]
+            result[i, j] = fft_differences(a_bitmaps, [b[k].bitmap for k in j], ALIGN_RADIUS)[0]
+        elif len(i):
+            a_rows, a_cols, a_counts = stack_bitmaps([a[k].bitmap.transformed(name) for k in i])
+            b_rows, b_cols, b_counts = stack_bitmaps([b[k].bitmap for k in j])
+            result[i, j] = batch_difference(a_rows, a_cols, a_counts, b_rows, b_cols, b_counts, size)
+        return result
+
+    pre = differences("IDENTITY")
+    relation = np.full(pre.shape, "no match", dtype=object)
+    found = np.zeros(pre.shape, dtype=bool)
+
+    def mark(matches, name):
+        matches = matches & ~found
+        relation[matches] = name
+        found[matches] = True
+
+    mark(pre <= 0.2, "UNCHANGED")
+    for i in range(1, 4):
+        post = differences("ROTATED_" + str(i * 90))
+        # object_rotated reports a 270 degree turn as ROTATED_90
+        mark(np.abs(pre - post) > 0.05, "ROTATED_90" if i == 3 else "ROTATED_" + str(i * 90))
+    for name in ["FLIP_LR", "FLIP_UD"]:
+        post = differences(name)
+        mark((np.abs(pre - post) >= TOLERANCE) & (post < TOLERANCE), name)
+
+    relation[~same_size] = "no match"
+    return relation, pre
+
+# The relation relation_matrix finds between every node of a and every node of
+# b, and the cost of pairing them for node_relations, cached by the nodes'
+# content. Nodes that are exactly the same shape in the same place share a
+# bitmap key, so a dict lookup finds them without comparing pixels; they are
+# UNCHANGED, as object_unchanged would find with a difference of 0
+def pair_relations(a, b):
+    key = ("pair_relations", tuple(i.bitmap.key for i in a), tuple(i.bitmap.key for i in b)) + alignment_key()
+    found, result = comparison_cache.get(key)
+    if found:
+        return result
+    count("node pairs", len(a) * len(b))
+
+    places = {}
+    for j, node in enumerate(b):
+        places.setdefault(node.bitmap.key, []).append(j)
+    same = np.zeros((len(a), len(b)), dtype=bool)
+    for i, node in enumerate(a):
+        same[i, places.get(node.bitmap.key, [])] = True
+
+    relation, pre = relation_matrix(a, b, same)
+    relation[same] = "UNCHANGED"
+    pre[same] = 0
+    cost = np.array([[RELATION_COSTS.get(i, NO_MATCH_COST) for i in row] for row in relation], dtype=float)
+    cost += np.minimum(pre, 1) / 2
+
+    result = (relation, cost)
+    comparison_cache.put(key, result)
+    return result
+
+# The relations of the nodes of a to those of b as the original matching loops
+# list them. Each node of a in turn takes the first node of b it is related
+# to, and every node of b it is not related to on the way adds a "no match".
+# Nodes in a_matched and b_matched are passed over, and the nodes matched here
+# are added to them
+def greedy_relations(a, b, a_matched, b_matched):
+    relations = []
+    if not a or not b:
+        return relations
+    relation = pair_relations(a, b)[0]
+    for i in range(len(a)):
+        if i in a_matched:
+            continue
+        for j in range(len(b)):
+            if j in b_matched:
+                continue
+            relations.append(relation[i, j])
+            if relation[i, j] != "no match":
+                a_matched.add(i)
+                b_matched.add(j)
+                break
+    return relations
+
+# The relation of every node of a to its match in b, in node order, "no match"
+# for the nodes left unmatched. Nodes are paired by an optimal assignment that
+# prefers unchanged over rotated over flipped shapes and the closest shapes
+# among those
+def node_relations(a, b):
+    if not a or not b:
+        return []
+    relation, cost = pair_relations(a, b)
+    relations = ["no match"] * len(a)
+    for i, j in zip(*linear_assignment(cost)):
+        relations[i] = relation[i, j]
+    return relations
+
+
 ######################################################################
 #####    FRAME CLASS
 #####
 ######################################################################
+
+# How many times each Frame feature was computed while solving the current
+# problem, Agent.Solve copies it to problem.feature_counts
+feature_counts = Counter()
+
+class Feature:
+    '''Frame attribute computed by the named method the first time it is read,
+    the result is kept in the Frame's slot of the same name with a leading
+    underscore'''
+
+    def __init__(self, method):
+        self.method = method
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.slot = "_" + name
+
+    def __get__(self, frame, owner=None):
+        if frame is None:
+            return self
+        try:
+            return getattr(frame, self.slot)
+        except AttributeError:
+            pass
+        stats = profiling.stats
+        if stats is None:
+            value = getattr(frame, self.method)()
+        else:
+            start = perf_counter()
+            value = getattr(frame, self.method)()
+            stats.add_time(self.method, perf_counter() - start)
+        setattr(frame, self.slot, value)
+        feature_counts[self.name] += 1
+        return value
+
 class Frame:
     '''Frame is the relationship between two/three figures in a Ravens problem'''
 
-    def __init__(self, figures):
+    # Features are only worked out when the scorer first needs them
+    blackdifference = Feature("get_black_difference")
+    nodes = Feature("get_nodes")
+    nodedifference = Feature("get_node_difference")
+    blackratio = Feature("get_black_ratio")
+    transformable = Feature("is_transformable")
+    simple_transform = Feature("check_simple_transform")
+    and_or_xor = Feature("check_and_or_xor")
+    semantic_net = Feature("get_net")
+
+    __slots__ = ("figures", "tensor", "images", "_blackdifference", "_nodes", "_nodedifference", "_blackratio",
+                 "_transformable", "_simple_transform", "_and_or_xor", "_semantic_net")
+
+    @profiled("Frame")
+    def __init__(self, figures, tensor=None):
         self.figures = figures
+        self.tensor = tensor
         self.images = []
         for i in self.figures:
-            self.images.append(i.attr["Image"])
-        self.blackdifference = self.get_black_difference()
-        self.nodes = self.get_nodes()
-        self.nodedifference = self.get_node_difference()
-        self.blackratio = self.get_black_ratio()
-        self.transformable = self.is_transformable()
-        self.simple_transform = self.check_simple_transform()
-        self.and_or_xor = self.check_and_or_xor()
-        self.semantic_net = self.get_net() #if len(self.nodes[0]) > 1 else "none"
+            self.images.append(i.attr["Bitmap"])
 
     def get_net(self):
         net = {"ab": [], "bc": [], "ac": []}
 
-        if len(self.nodes) == 3:
-
-            if len(self.nodes[0]) > 10 or len(self.nodes[1]) > 10 or len(self.nodes[2]) > 10:
-                return net
-            for a in self.nodes[0]:
-                for b in self.nodes[1]:
-                    if a.transform == "not matched" and b.transform == "not matched":
-                        if 0.95 < np.sum(a.pixels) / np.sum(b.pixels) < 1.05:
-                            unchange = object_unchanged(a.pixels, b.pixels, 0.2)
-                            rotated = object_rotated(a.pixels, b.pixels)
-                            fliplr = object_fliplr(a.pixels, b.pixels)
-                            flipud = object_flipud(a.pixels, b.pixels)
-                            if unchange == "UNCHANGED":
-                                net["ab"].append("UNCHANGED")
-                                a.transform = unchange
-                                b.transform = unchange
-                                break
-                            elif rotated == "ROTATED_90" or rotated == "ROTATED_180" or rotated == "ROTATED_270":
-                                net["ab"].append(rotated)
-                                a.transform = rotated
-                                b.transform = rotated
-                                break
-                            elif fliplr == "FLIP_LR":
-                                net["ab"].append(fliplr)
-                                a.transform = fliplr
-                                b.transform = fliplr
-                                break
-                            elif flipud == "FLIP_UD":
-                                net["ab"].append(flipud)
-                                a.transform = flipud
-                                b.transform = flipud
-                                break
-                            else:
-                                net["ab"].append("no match")
-                        else:
-                            net["ab"].append("no match")
-
-            [i.reset() for i in self.nodes[0]]
-            [i.reset() for i in self.nodes[1]]
-
-
-            for a in self.nodes[1]:
-                for b in self.nodes[2]:
-                    if a.transform == "not matched" and b.transform == "not matched":
-                        if 0.95 < np.sum(a.pixels) / np.sum(b.pixels) < 1.05:
-                            unchange = object_unchanged(a.pixels, b.pixels, 0.2)
-                            rotated = object_rotated(a.pixels, b.pixels)
-                            fliplr = object_fliplr(a.pixels, b.pixels)
-                            flipud = object_flipud(a.pixels, b.pixels)
-                            if unchange == "UNCHANGED":
-                                net["bc"].append("UNCHANGED")
-                                a.transform = unchange
-                                b.transform = unchange
-                                break
-                            elif rotated == "ROTATED_90" or rotated == "ROTATED_180" or rotated == "ROTATED_270":
-                                net["bc"].append(rotated)
-                                a.transform = rotated
-                                b.transform = rotated
-                                break
-                            elif fliplr == "FLIP_LR":
-                                net["bc"].append(fliplr)
-                                a.transform = fliplr
-                                b.transform = fliplr
-                                break
-                            elif flipud == "FLIP_UD":
-                                net["bc"].append(flipud)
-                                a.transform = flipud
-                                b.transform = flipud
-                                break
-                            else:
-                                net["bc"].append("no match")
-                        else:
-                            net["bc"].append("no match")
-            [i.reset() for i in self.nodes[1]]
-            [i.reset() for i in self.nodes[2]]
-
-            for a in self.nodes[1]:
-                for b in self.nodes[2]:
-                    if a.transform == "not matched" and b.transform == "not matched":
-                        if 0.95 < np.sum(a.pixels) / np.sum(b.pixels) < 1.05:
-                            unchange = object_unchanged(a.pixels, b.pixels, 0.2)
-                            rotated = object_rotated(a.pixels, b.pixels)
-                            fliplr = object_fliplr(a.pixels, b.pixels)
-                            flipud = object_flipud(a.pixels, b.pixels)
-                            if unchange == "UNCHANGED":
-                                net["ac"].append("UNCHANGED")
-                                a.transform = unchange
-                                b.transform = unchange
-                                break
-                            elif rotated == "ROTATED_90" or rotated == "ROTATED_180" or rotated == "ROTATED_270":
-                                net["ac"].append(rotated)
-                                a.transform = rotated
-                                b.transform = rotated
-                                break
-                            elif fliplr == "FLIP_LR":
-                                net["ac"].append(fliplr)
-                                a.transform = fliplr
-                                b.transform = fliplr
-                                break
-                            elif flipud == "FLIP_UD":
-                                net["ac"].append(flipud)
-                                a.transform = flipud
-                                b.transform = flipud
-                                break
-                            else:
-                                net["ac"].append("no match")
-                        else:
-                            net["ac"].append("no match")
-            [i.reset() for i in self.nodes[0]]
-            [i.reset() for i in self.nodes[2]]
-
+        if len(self.nodes) != 3:
+            return net
+
+        if NODE_ASSIGNMENT:
+            net["ab"] = node_relations(self.nodes[0], self.nodes[1])
+            net["bc"] = node_relations(self.nodes[1], self.nodes[2])
+            # "ac" has always repeated the relations of the second and third
+            # figures, nothing scores it
+            net["ac"] = list(net["bc"])
+            return net
+
+        if len(self.nodes[0]) > 10 or len(self.nodes[1]) > 10 or len(self.nodes[2]) > 10:
+            return net
+        # Nodes of each figure matched by a net and not yet passed over again.
+        # As in the original loops, "ac" repeats the second and third figures
+        # and the middle figure keeps its matches, which the next net built
+        # with that figure sees, see solve_three
+        a, b, c = [i.attr.setdefault("Matched", set()) for i in self.figures]
+        net["ab"] = greedy_relations(self.nodes[0], self.nodes[1], a, b)
+        a.clear()
+        b.clear()
+        net["bc"] = greedy_relations(self.nodes[1], self.nodes[2], b, c)
+        b.clear()
+        c.clear()
+        net["ac"] = greedy_relations(self.nodes[1], self.nodes[2], b, c)
+        a.clear()
+        c.clear()
         return net
 
     def get_black_difference(self):
+        if self.tensor is not None:
+            f = self.figures
+            pairs = [(0, 1), (1, 2), (0, 2)] if len(f) > 2 else [(0, 1)]
+            return [self.tensor.difference(f[i], f[j]) for i, j in pairs]
+
         diff = []
         diff.append(difference(self.images[0], self.images[1]))
         if len(self.images) > 2:
@@ -340,16 +1254,17 @@ class Frame:
 
     def get_black_ratio(self):
         ratio = []
-        if np.sum(self.images[1]) == 0:
-            ratio.append(np.sum(self.images[0]))
+        counts = [i.count for i in self.images]
+        if counts[1] == 0:
+            ratio.append(counts[0])
         else:
-            ratio.append(np.sum(self.images[0]) / np.sum(self.images[1]))
-        if len(self.images) > 2 and np.sum(self.images[2]) != 0:
-            ratio.append(np.sum(self.images[1]) / np.sum(self.images[2]))
-            ratio.append(np.sum(self.images[0]) / np.sum(self.images[2]))
+            ratio.append(counts[0] / counts[1])
+        if len(self.images) > 2 and counts[2] != 0:
+            ratio.append(counts[1] / counts[2])
+            ratio.append(counts[0] / counts[2])
         else:
-            ratio.append(np.sum(self.images[1]))
-            ratio.append(np.sum(self.images[0]))
+            ratio.append(counts[1])
+            ratio.append(counts[0])
         return ratio
 
     def is_transformable(self):
@@ -400,24 +1315,34 @@ class Frame:
     def check_and_or_xor(self):
 
         length = len(self.images)
-        operator = [-1, -1, -1] if length == 3 else [-1, -1]
         if length == 2: 
             return "none"
+        elif self.tensor is not None:
+            return self.tensor.and_or_xor(*self.figures)
         else:
-            and_img = self.images[0] + self.images[1]
-            and_img -= IMAGE_INTENSITY
-            if difference(and_img, self.images[2]) < TOLERANCE:
+            if below_threshold(self.images[0] & self.images[1], self.images[2], TOLERANCE):
                 return "AND"
-            or_img = self.images[0] + self.images[1]
-            or_img[np.where(or_img > IMAGE_INTENSITY)] = IMAGE_INTENSITY
-            if difference(or_img, self.images[2]) < TOLERANCE:
-                return "OR"         
-            xor_img = self.images[0] + self.images[1]
-            xor_img[np.where(or_img > IMAGE_INTENSITY)] = 0
-            if difference(xor_img, self.images[2]) < TOLERANCE:
+            if below_threshold(self.images[0] | self.images[1], self.images[2], TOLERANCE):
+                return "OR"
+            if below_threshold(self.images[0] ^ self.images[1], self.images[2], TOLERANCE):
                 return "XOR"
         return "none"
 
+    # The frame's features as a fixed length array, laid out as in SCORING
+    # The simple transforms and semantic net are only worked out when
+    # transforms and net are set
+    def feature_vector(self, transforms=True, net=True):
+        vector = np.full(FEATURE_LENGTH, np.nan)
+        vector[BLACK_DIFFERENCE][:len(self.blackdifference)] = self.blackdifference
+        vector[BLACK_RATIO][:len(self.blackratio)] = self.blackratio
+        vector[NODE_DIFFERENCE][:len(self.nodedifference)] = self.nodedifference
+        if transforms:
+            vector[SIMPLE_TRANSFORM][:len(self.simple_transform)] = [TRANSFORM_CODES[i] for i in self.simple_transform]
+        vector[AND_OR_XOR] = OPERATOR_CODES[self.and_or_xor]
+        if net:
+            vector[SAME_NET] = sorted(self.semantic_net["ab"]) == sorted(self.semantic_net["bc"])
+        return vector
+
     def print_frame(self):
         print("#################################")
         print("Frame contains: ")
@@ -438,24 +1363,143 @@ class Frame:
             nodes.append(i.attr["Nodes"])
         return nodes
 
+######################################################################
+#####    SCORING
+#####
+######################################################################
+
+# Layout of Frame.feature_vector(), lists shorter than their slot are padded
+# with nan, which never scores
+BLACK_DIFFERENCE = slice(0, 3)
+BLACK_RATIO = slice(3, 6)
+NODE_DIFFERENCE = slice(6, 9)
+SIMPLE_TRANSFORM = slice(9, 12)
+AND_OR_XOR = 12
+SAME_NET = 13
+FEATURE_LENGTH = 14
+
+class Transform(IntEnum):
+    '''The simple transform between two figures, as coded in the
+    SIMPLE_TRANSFORM slots. NONE is the -1 the object_ functions return when
+    they find nothing'''
+    NONE = -1
+    UNCHANGED = 1
+    FLIP_UD = 2
+    FLIP_LR = 3
+    ROTATED_90 = 4
+    ROTATED_180 = 5
+    ROTATED_270 = 6
+
+# Code of each result of check_simple_transform
+TRANSFORM_CODES = {-1: Transform.NONE}
+TRANSFORM_CODES.update((i.name, i) for i in Transform if i is not Transform.NONE)
+OPERATOR_CODES = {"none": 0, "AND": 1, "OR": 2, "XOR": 3}
+
+# Points for each black difference or ratio within 0.05, 0.1 and 0.15
+def closeness(a, b):
+    distance = np.abs(a - b)
+    return ((distance < 0.05) * 1 + (distance < 0.1) + (distance < 0.15)).sum(axis=-1)
+
+# Confidence of every candidate frame against every reference frame, the same
+# score compare_frames gives one pair, as a (candidates, references) array
+#
+# The score is made of a cheap stage (black difference and ratio, node counts
+# and AND/OR/XOR) and a detailed stage (simple transforms and semantic nets),
+# either can be left out, the two added together give the full score
+@profiled("compare")
+def score_frames(candidates, references, problem, cheap=True, detailed=True):
+    # Only Basic D problems score the semantic net
+    net = detailed and "Basic Problem D-" in problem.name
+    c = np.array([i.feature_vector(detailed, net) for i in candidates])[:, None, :]
+    r = np.array([i.feature_vector(detailed, False) for i in references])[None, :, :]
+
+    confidence = np.zeros((c.shape[0], r.shape[1]))
+    if cheap:
+        confidence += 1
+        confidence += closeness(r[..., BLACK_DIFFERENCE], c[..., BLACK_DIFFERENCE])
+        confidence += closeness(r[..., BLACK_RATIO], c[..., BLACK_RATIO])
+
+        nodes = r[..., NODE_DIFFERENCE]
+        confidence += 5 * ((nodes == c[..., NODE_DIFFERENCE]) & (nodes != 0)).sum(axis=-1)
+
+        operator = r[..., AND_OR_XOR]
+        confidence += 2 * ((operator == c[..., AND_OR_XOR]) & (operator != OPERATOR_CODES["none"]))
+
+    if detailed:
+        simple = r[..., SIMPLE_TRANSFORM]
+        confidence += 5 * ((simple == c[..., SIMPLE_TRANSFORM]) & (simple != Transform.NONE)).sum(axis=-1)
+
+        # compare semantic nets.... really poorly
+        if net:
+            confidence += 10 * c[..., SAME_NET]
+
+    return confidence
+
+# The most the detailed stage of score_frames can add to one answer. A simple
+# transform slot only scores where the reference frame has a transform, and
+# check_simple_transform only looks for one where the frame is transformable
+# (only the first pair of a two figure frame)
+def largest_detailed_score(groups, problem):
+    net = 10 if "Basic Problem D-" in problem.name else 0
+    gain = 0
+    for frames, references in groups:
+        for reference in references:
+            transformable = reference.transformable
+            if len(reference.figures) != 3:
+                transformable = transformable[:1]
+            gain += 5 * sum(transformable) + net
+    return gain
+
+
 ######################################################################
 #####    NODE CLASS
 #####
 ######################################################################
 class Node:
-    '''Holds information about each object inside a raven figure'''
+    '''Holds information about each object inside a raven figure, a view of
+    one row of its figure's NodeTable'''
 
-    def __init__(self, pixels, match, transform, match_weight, name):
-        self.pixels = pixels
-        self.match = match
-        self.transform = transform
-        self.match_weight = match_weight
-        self.name = name
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    # Only the bounding box of the shape is kept, see pixels
+    @property
+    def mask(self):
+        return self.table.masks[self.index]
+
+    @property
+    def bbox(self):
+        return tuple(int(i) for i in self.table.boxes[self.index])
+
+    @property
+    def area(self):
+        return int(self.table.areas[self.index])
+
+    @property
+    def shape(self):
+        return self.table.shape
+
+    @property
+    def name(self):
+        return "Node_" + str(self.table.labels[self.index])
 
-    def reset(self):
-        self.match = 'none'
-        self.transform = 'not matched'
-        self.match_weight = 0
+    @property
+    def pixels(self):
+        '''The shape drawn on a full size figure, rebuilt from the mask on each call'''
+        x0, y0, x1, y1 = self.bbox
+        pixels = np.zeros(self.shape, dtype=bool)
+        pixels[x0:x1, y0:y1] = self.mask
+        return pixels
+
+    @property
+    def bitmap(self):
+        '''The full size figure as a Bitmap, packed the first time it is needed'''
+        if self.table.bitmaps[self.index] is None:
+            self.table.bitmaps[self.index] = Bitmap(self.pixels)
+        return self.table.bitmaps[self.index]
 
 
 ######################################################################
@@ -463,6 +1507,25 @@ class Node:
 #####
 ######################################################################
 
+class SolveResult:
+    '''The answer to one problem of a batch, with what solving it took'''
+
+    def __init__(self, problem, answer, seconds):
+        self.problem_set = problem.problemSetName
+        self.problem = problem.name
+        self.answer = answer
+        self.seconds = seconds
+        self.feature_counts = problem.feature_counts
+        self.pruned = getattr(problem, "pruned", None)
+        self.peak_memory = problem.peak_memory
+        self.stats = problem.stats
+
+    def to_dict(self):
+        return {"problem_set": self.problem_set, "problem": self.problem, "answer": self.answer,
+                "seconds": self.seconds, "feature_counts": self.feature_counts, "pruned": self.pruned,
+                "peak_memory": self.peak_memory,
+                "stats": self.stats.to_dict() if self.stats is not None else None}
+
 class Agent:
     # The default constructor for your Agent. Make sure to execute any
     # processing necessary before your Agent starts solving problems here.
@@ -472,225 +1535,111 @@ class Agent:
     def __init__(self):
         pass
 
+    @profiled("create_nodes")
     def create_nodes(self, figures):
         '''Seperates each figure into nodes for the creation of the semantic net '''
         for figure_name in figures:
             this_figure = figures[figure_name]
+            pending = getattr(this_figure, "attr", {}).get("Labels")
             this_figure.attr = {}
 
-            # Process the image for future operations
-            array = to_image_array(this_figure.visualFilename)
+            # Process the image for future operations, unless an earlier run
+            # did or prefetch already has
+            if pending is not None:
+                labels, cached = pending.result()
+                count("prefetched figures")
+            else:
+                labels, cached = load_labels(this_figure.visualFilename)
+            count("figure cache hits" if cached else "figure cache misses")
 
-            this_figure.attr["Image"] = color_shapes(array)
+            this_figure.attr["Image"] = labels
 
             # inv_array = np.zeros(array.shape)
             # inv_array[np.where(array == 0)] = 1
 
-            this_figure.attr["Nodes"] = []
+            nodes = []
 
             # this_figure.attr["Inverse"] = color_shapes(inv_array)
             # this_figure.attr["Whites"] = []
 
             # Seperate each shape into its own object
-            for i in range(1, int(np.amax(this_figure.attr["Image"])) + 1):
-                pixels = np.zeros(this_figure.attr["Image"].shape)
-
-                # Set pixel back to IMAGE_INTENSITY rather than its 'color'
-                pixels[np.where(this_figure.attr["Image"] == i)] = IMAGE_INTENSITY
-
-                if np.sum(pixels) <= OBJECT_THRESHOLD: 
-                    if np.sum(pixels) > 0:
-                        logger.warning("Found an object with " + str(np.sum(pixels)) + "pixels, passed")
-                    pass
+            components = extract_components(this_figure.attr["Image"])
+            for i, (area, bbox, mask) in enumerate(components, 1):
+                if area <= OBJECT_THRESHOLD: 
+                    if area > 0:
+                        logger.warning("Found an object with " + str(float(area)) + "pixels, passed")
                 else:
-                    node = Node(pixels, "none", "not matched", 0, "Node_" + str(i))
-                    this_figure.attr["Nodes"].append(node)
-                    # test_image = Image.fromarray(tmp)
-                    # test_image.show()
+                    nodes.append((i, bbox, mask))
+            this_figure.attr["Nodes"] = NodeTable(nodes, this_figure.attr["Image"].shape)
             # logger.debug("Figure " + str(figure_name) + " has " + str(len(this_figure.attr["Nodes"])) + " nodes")
 
             #  uncolor component images
-            this_figure.attr["Image"][np.where(this_figure.attr["Image"] > 1)] = IMAGE_INTENSITY
-
-    # method that sets objects frame values
-    def match(self, a, b, transform):
-        if transform == "DELETED":
-            a.transform = transform
-        elif transform == "ADDED":
-            b.transform = transform
-        else:
-            a.transform = transform
-            a.match = b.name
-            b.match = a.name
-            b.transform = transform
-
-    def match_nodes(self, fig_a, fig_b):
-        # print("Entered match_nodes")
-        # print("Frame: " + str(fig_a.name))
-        # print("Frame: " + str(fig_b.name))
-        for a in fig_a.frame["Nodes"]:
-            for b in fig_b.frame["Nodes"]:
-
-                if a.match == "none":
-                    a.match_weight = 0
-                if b.match == "none":
-                    b.match_weight = 0
-
-                while True:
-                    transform = "no transform"
-                    if (a.match_weight and b.match_weight) == UNCHANGED_W:
-                        transform = object_unchanged(a, b)
-                        if transform == "UNCHANGED": 
-                            self.match(a, b, transform)
-                            break 
-                        else: 
-                            a.match_weight += 1
-                            b.match_weight += 1
-                    elif (a.match_weight <= ROTATED_W) and (b.match_weight <= ROTATED_W):
-                        transform = object_rotated(a, b)
-                        if (transform == "ROTATED_90") or (transform == "ROTATED_180") or (transform == "ROTATED_270"): 
-                            self.match(a, b, transform)
-                            break 
-                        else: 
-                            a.match_weight += 1
-                            b.match_weight += 1
-                    elif (a.match_weight <= FILLED_W) and (b.match_weight <= FILLED_W):
-                        transform = object_filled(a, b)
-                        if transform == "FILLED": 
-                            self.match(a, b, transform)
-                            break 
-                        else: 
-                            a.match_weight += 1
-                            b.match_weight += 1
-                    else:
-                        break
-
-        # print("object X length " + str(len(fig_a.frame["Nodes"])))
-        # print("object Y length " + str(len(fig_b.frame["Nodes"])))
-
-        #######
-        # Checks for added or deleted objects
-        for a in fig_a.frame["Nodes"]:
-            for b in fig_b.frame["Nodes"]:
-
-                if (len(fig_a.frame["Nodes"]) > len(fig_b.frame["Nodes"])) and a.match == "none":
-                    a.transform = "DELETED"
-                elif (len(fig_a.frame["Nodes"]) < len(fig_b.frame["Nodes"])) and b.match == "none":
-                    b.transform = "ADDED"
-
-    def reset_frame_nodes(self, a):
-        for i in a:
-            i.transform = "not matched"
-            i.match = "none"
-            i.match_weight = 0
-
-    def generate_semantic_net(self, fig1, fig2):
-        
-        if self.match_nodes(fig1, fig2) == -1:
-            return -1
-
-        net = [i.transform for i in fig1.frame["Nodes"]]   
-        [i.reset() for i in fig1.frame["Nodes"]]
-        [i.reset() for i in fig2.frame["Nodes"]]
-
-        return net
+            this_figure.attr["Image"][this_figure.attr["Image"] > 1] = IMAGE_INTENSITY
+            this_figure.attr["Bitmap"] = Bitmap(this_figure.attr["Image"])
 
     def compare_frames(self, fr_1, fr_2, problem):
-        confidence = 1
-
-        # Compare black difference
-        for i, j in zip(fr_1.blackdifference, fr_2.blackdifference):
-            if abs(i - j) < 0.05:
-                confidence += 3
-            elif abs(i - j) < 0.1:
-                confidence += 2
-            elif abs(i - j) < 0.15:
-                confidence += 1
-
-        # Compare black ratio
-        for i, j in zip(fr_1.blackratio, fr_2.blackratio):
-            if abs(i - j) < 0.05:
-                confidence += 3
-            elif abs(i - j) < 0.1:
-                confidence += 2
-            elif abs(i - j) < 0.15:
-                confidence += 1
-
-        # Compare number of nodes
-        for (i, j) in zip(fr_1.nodedifference, fr_2.nodedifference):
-            if i != j:
-                confidence -= 0
-            elif i == j and i != 0:
-                confidence += 5
-            else:
-                confidence += 0
-
-        # Compare simple transforms
-        for (i, j) in zip(fr_1.simple_transform, fr_2.simple_transform):
-            if i != j:
-                confidence -= 0
-            elif i == j and i != -1:
-                confidence += 5
-
-        # Check for and or xor
-        if fr_1.and_or_xor == fr_2.and_or_xor and fr_1.and_or_xor != "none":
-            confidence += 2
-
-        # compare semantic nets.... really poorly
-        ab1 = sorted(fr_1.semantic_net["ab"])
-        ab2 = sorted(fr_2.semantic_net["ab"])
-        bc1 = sorted(fr_1.semantic_net["bc"])
-        bc2 = sorted(fr_2.semantic_net["bc"])
-        ac1 = sorted(fr_1.semantic_net["ac"])
-        ac2 = sorted(fr_2.semantic_net["ac"])
-
-        # if ab1 == bc1 and bc1 == ac1:
-        #     if ab2 == bc2 and bc2 == ac2:
-        #         confidence += 10
-
-        if "Basic Problem D-" in problem.name:
-            if ab2 == bc2:
-                confidence += 10
-        # TODO add count edges
-        # TODO add count corners
-
-        return confidence
+        return int(score_frames([fr_2], [fr_1], problem)[0, 0])
+
+    # Keeps the answers whose cheap score is close enough to the leader's
+    def prune_answers(self, scores, gain):
+        if not PRUNE_ANSWERS:
+            return np.arange(len(scores))
+        margin = gain if PRUNE_MARGIN is None else PRUNE_MARGIN
+        keep = np.flatnonzero(scores + margin >= scores.max())
+        if PRUNE_TOP_K:
+            keep = np.sort(keep[np.argsort(-scores[keep], kind="stable")[:PRUNE_TOP_K]])
+        return keep
+
+    @profiled("scoring")
+    def score_answers(self, problem, groups, numbers):
+        '''Scores every answer, groups pairs the prefix of each answer's frames
+        with the frames they are compared to. All answers get the cheap stage,
+        only those prune_answers keeps get the detailed one'''
+        groups = [([problem.frames[candidate + str(i)] for i in numbers], [problem.frames[i] for i in references])
+                  for candidate, references in groups]
+
+        scores = np.zeros(len(numbers))
+        for frames, references in groups:
+            scores += score_frames(frames, references, problem, detailed=False).sum(axis=1)
+
+        keep = self.prune_answers(scores, largest_detailed_score(groups, problem))
+        for frames, references in groups:
+            scores[keep] += score_frames([frames[i] for i in keep], references, problem, cheap=False).sum(axis=1)
+
+        skipped = len(numbers) - len(keep)
+        problem.pruned = {"answers": skipped, "frames": skipped * len(groups)}
+        logger.info("Pruned : " + str(problem.pruned))
+        return scores
 
     def solve_two(self, problem):
         p = problem
 
-        answer = 1
-        confidence = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0}
-
-
         letters = ["A", "B", "C"]
         numbers = [1, 2, 3, 4, 5, 6]
 
         problem.frames = {}
-        problem.frames["A" + "B"] = Frame([problem.figures["A"], problem.figures["B"]])
+        tensor = ProblemTensor(problem.figures) if TENSOR_MODE else None
+        problem.frames["A" + "B"] = Frame([problem.figures["A"], problem.figures["B"]], tensor)
 
-        problem.frames["A" + "C"] = Frame([problem.figures["A"], problem.figures["C"]])
+        problem.frames["A" + "C"] = Frame([problem.figures["A"], problem.figures["C"]], tensor)
 
         for i in numbers:
-            problem.frames["B" + str(i)] = Frame([problem.figures["B"], problem.figures[str(i)]])
-            problem.frames["C" + str(i)] = Frame([problem.figures["C"], problem.figures[str(i)]])
+            problem.frames["B" + str(i)] = Frame([problem.figures["B"], problem.figures[str(i)]], tensor)
+            problem.frames["C" + str(i)] = Frame([problem.figures["C"], problem.figures[str(i)]], tensor)
 
         if DB_LEVEL == "DEBUG":
             for frame in problem.frames:
                 problem.frames[frame].print_frame()
 
 
-        for i in numbers:
-            confidence[i] += self.compare_frames(problem.frames["AB"], problem.frames["C" + str(i)], problem)
-            confidence[i] += self.compare_frames(problem.frames["AC"], problem.frames["B" + str(i)], problem)
+        # Each answer's C and B frames are scored against AB and AC
+        scores = self.score_answers(problem, [("C", ["AB"]), ("B", ["AC"])], numbers)
+        confidence = {i: int(score) for i, score in zip(numbers, scores)}
 
         logger.debug("Confidence is " + str(confidence))
 
-        conf = confidence[1]
-        for key in confidence:
-            if confidence[key] > conf:
-                answer = key
-                conf = confidence[key]
+        answer = numbers[int(np.argmax(scores))]
+        conf = confidence[answer]
 
         if DB_LEVEL == "DEBUG" or DB_LEVEL == "INFO":
             problem.frames["AB"].print_frame()
@@ -709,57 +1658,51 @@ class Agent:
 
         letters = ["A", "B", "C", "D", "E", "F", "G", "H"]
         numbers = [1, 2, 3, 4, 5, 6, 7, 8]
-        confidence = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 7: 0, 8: 0}  
-        answer = 1
 
         problem.frames = {}
+        tensor = ProblemTensor(problem.figures) if TENSOR_MODE else None
 
         # Normal horizontal and vertical frames
-        problem.frames["A" + "B" + "C"] = Frame([problem.figures["A"], problem.figures["B"], problem.figures["C"]])
+        problem.frames["A" + "B" + "C"] = Frame([problem.figures["A"], problem.figures["B"], problem.figures["C"]], tensor)
 
-        problem.frames["D" + "E" + "F"] = Frame([problem.figures["D"], problem.figures["E"], problem.figures["F"]])
-        problem.frames["A" + "D" + "G"] = Frame([problem.figures["A"], problem.figures["D"], problem.figures["G"]])
-        problem.frames["B" + "E" + "H"] = Frame([problem.figures["B"], problem.figures["E"], problem.figures["H"]])
+        problem.frames["D" + "E" + "F"] = Frame([problem.figures["D"], problem.figures["E"], problem.figures["F"]], tensor)
+        problem.frames["A" + "D" + "G"] = Frame([problem.figures["A"], problem.figures["D"], problem.figures["G"]], tensor)
+        problem.frames["B" + "E" + "H"] = Frame([problem.figures["B"], problem.figures["E"], problem.figures["H"]], tensor)
 
         # Add diagonals
 
-        problem.frames["B" + "F" + "G"] = Frame([problem.figures["B"], problem.figures["F"], problem.figures["G"]])
-        problem.frames["C" + "D" + "H"] = Frame([problem.figures["C"], problem.figures["D"], problem.figures["H"]])
+        problem.frames["B" + "F" + "G"] = Frame([problem.figures["B"], problem.figures["F"], problem.figures["G"]], tensor)
+        problem.frames["C" + "D" + "H"] = Frame([problem.figures["C"], problem.figures["D"], problem.figures["H"]], tensor)
 
 
         for i in numbers:
-            problem.frames["C" + "F" + str(i)] = Frame([problem.figures["C"], problem.figures["F"], problem.figures[str(i)]])
-            problem.frames["G" + "H" + str(i)] = Frame([problem.figures["G"], problem.figures["H"], problem.figures[str(i)]])
-            problem.frames["A" + "E" + str(i)] = Frame([problem.figures["A"], problem.figures["E"], problem.figures[str(i)]])
+            problem.frames["C" + "F" + str(i)] = Frame([problem.figures["C"], problem.figures["F"], problem.figures[str(i)]], tensor)
+            problem.frames["G" + "H" + str(i)] = Frame([problem.figures["G"], problem.figures["H"], problem.figures[str(i)]], tensor)
+            problem.frames["A" + "E" + str(i)] = Frame([problem.figures["A"], problem.figures["E"], problem.figures[str(i)]], tensor)
+
 
+        # get_net leaves matches on the nodes of a frame's middle figure, which the
+        # nets built after it see, so nets are built in the order the frames were made
+        if "Basic Problem D-" in problem.name and not NODE_ASSIGNMENT:
+            [problem.frames[frame].semantic_net for frame in problem.frames]
 
         if DB_LEVEL == "DEBUG":
             for frame in problem.frames:
                 problem.frames[frame].print_frame()
 
-        for i in numbers:
-            confidence[i] += self.compare_frames(problem.frames["ABC"], problem.frames["GH" + str(i)], problem) * 1.0
-            confidence[i] += self.compare_frames(problem.frames["DEF"], problem.frames["GH" + str(i)], problem) * 1.0
-            confidence[i] += self.compare_frames(problem.frames["ADG"], problem.frames["CF" + str(i)], problem) * 1.0
-            confidence[i] += self.compare_frames(problem.frames["BEH"], problem.frames["CF" + str(i)], problem) * 1.0
-            if "Basic Problem E-" in problem.name:
-                pass
-            else:
-                confidence[i] += self.compare_frames(problem.frames["BFG"], problem.frames["AE" + str(i)], problem) * 1.0
-                confidence[i] += self.compare_frames(problem.frames["CDH"], problem.frames["AE" + str(i)], problem) * 1.0
+        # Each answer's GH, CF and AE frames are scored against the complete
+        # rows, columns and diagonals
+        groups = [("GH", ["ABC", "DEF"]), ("CF", ["ADG", "BEH"])]
+        if "Basic Problem E-" not in problem.name:
+            groups.append(("AE", ["BFG", "CDH"]))
 
+        scores = self.score_answers(problem, groups, numbers)
+        confidence = {i: float(score) for i, score in zip(numbers, scores)}
 
         logger.info("Confidence is " + str(confidence))
 
-        # if max(confidence) >10:
-        #             conf = confidence[1]
-
-        conf = confidence[1]
-
-        for key in confidence:
-            if confidence[key] > conf:
-                answer = key
-                conf = confidence[key]
+        answer = numbers[int(np.argmax(scores))]
+        conf = confidence[answer]
 
         if DB_LEVEL == "DEBUG" or DB_LEVEL == "INFO":
             problem.frames["ABC"].print_frame()
@@ -781,6 +1724,32 @@ class Agent:
 
         return answer
 
+    # Drops the images, nodes and frames Solve kept on a problem, keeping its
+    # answer and stats. Called once the answer has been written out
+    def release(self, problem):
+        for figure in problem.figures.values():
+            figure.attr = {}
+        problem.frames = {}
+
+    def iter_solve(self, problems, prefetch_depth=None, release=True):
+        '''Solves problems one after another with Solve, yielding a SolveResult
+        as each is answered. problems may be any iterable, it is read as it is
+        needed. The comparison and figure caches carry over from one problem
+        to the next, so shapes seen before are not compared again. Figures of
+        the problems ahead are loaded in the background as in prefetch, and
+        each problem is released once answered unless release is False'''
+        for problem in prefetch(problems, prefetch_depth):
+            start = perf_counter()
+            answer = self.Solve(problem)
+            result = SolveResult(problem, answer, perf_counter() - start)
+            if release:
+                self.release(problem)
+            yield result
+
+    def solve_batch(self, problems, prefetch_depth=None, release=True):
+        '''The SolveResult of every problem, in order, see iter_solve'''
+        return list(self.iter_solve(problems, prefetch_depth, release))
+
     # The primary method for solving incoming Raven's Progressive Matrices.
     # For each problem, your Agent's Solve() method will be called. At the
     # conclusion of Solve(), your Agent should return an int representing its
@@ -792,16 +1761,38 @@ class Agent:
     # Returning your answer as a string may cause your program to crash.
     def Solve(self, problem):
 
-
         t0 = time()
         print("**********Solving Problem : " + str(problem.name) + " ***********************")
-
-        self.create_nodes(problem.figures)
-
-        problem.answer = self.solve_two(problem) if problem.problemType == "2x2" else self.solve_three(problem)
+        feature_counts.clear()
+        profiling.stats = SolveStats(problem.name) if PROFILE else None
+        hits, misses = comparison_cache.hits, comparison_cache.misses
+        tracing = PROFILE_MEMORY and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+
+        try:
+            self.create_nodes(problem.figures)
+
+            problem.answer = self.solve_two(problem) if problem.problemType == "2x2" else self.solve_three(problem)
+        finally:
+            problem.stats, profiling.stats = profiling.stats, None
+            # The most memory allocated at once while solving, in bytes
+            problem.peak_memory = tracemalloc.get_traced_memory()[1] if tracing else None
+            if tracing:
+                tracemalloc.stop()
 
         t1 = time()
+        problem.feature_counts = dict(feature_counts)
+        if problem.peak_memory is not None:
+            logger.info("Peak memory : %d bytes" % problem.peak_memory)
+        if problem.stats is not None:
+            problem.stats.peak_memory = problem.peak_memory
+            problem.stats.add_time("Solve", t1 - t0)
+            problem.stats.count("comparison cache hits", comparison_cache.hits - hits)
+            problem.stats.count("comparison cache misses", comparison_cache.misses - misses)
+            logger.info("Stats : " + problem.stats.to_json())
         logger.info("Time is : %f" % (t1-t0));
+        logger.info("Features computed : " + str(problem.feature_counts))
         print("Answer is : " + str(problem.answer))
 
         return problem.answer
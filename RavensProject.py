@@ -11,29 +11,75 @@
 import os
 import sys
 import csv
+import argparse
+from multiprocessing import Pool
 
-from Agent import Agent
+from Agent import Agent, figure_cache
 from ProblemSet import ProblemSet
 from RavensGrader import grade
 
 def getNextLine(r):
     return r.readline().rstrip()
 
+# The names of the sets in ProblemSetList.txt, read as they are needed
+def problem_set_names():
+    with open(os.path.join("Problems","ProblemSetList.txt")) as r:
+        line = getNextLine(r)
+        while not line=="":
+            yield line
+            line = getNextLine(r)
+
+class ProblemStream(ProblemSet):
+    '''A ProblemSet that parses each problem's ProblemData.txt only when
+    iteration reaches it, and keeps none of them'''
+
+    def __init__(self, name):
+        self.name=name
+        self.problems=[]
+
+    def __iter__(self):
+        with open(os.path.join("Problems", self.name, "ProblemList.txt")) as r:
+            line = self.getNextLine(r)
+            while not line=="":
+                self.loadProblem(line)
+                yield self.problems.pop()
+                line = self.getNextLine(r)
+
+# Every problem of every set, in order, each parsed only when it is reached
+def stream_problems():
+    for name in problem_set_names():
+        yield from ProblemStream(name)
+
+# Each worker process of a parallel solve keeps its own agent
+worker_agent = None
+
+def start_worker():
+    global worker_agent
+    worker_agent = Agent()
+
+# Solves one problem and returns its row of AgentAnswers.csv
+def solve_in_worker(problem):
+    result = worker_agent.solve_batch([problem], 0)[0]
+    return "%s,%s,%d\n" % (result.problem_set, result.problem, result.answer)
+
 # The project's main solve method. This will generate your agent's answers
 # to all the current problems.
 #
+# Sets and problems are read from /Problems/ as they are reached, and each
+# problem's images, nodes and frames are released as soon as its answer is
+# written, so memory stays flat however many problems there are.
+#
+# With workers above 1 the problems are solved by a pool of that many
+# processes. Answers are still written in set and problem order. Otherwise
+# the figures of the next prefetch problems are loaded in the background,
+# Agent.PREFETCH problems when it is None.
+#
 # You do not need to use this method.
-def solve():
-    sets=[] # The variable 'sets' stores multiple problem sets.
-            # Each problem set comes from a different folder in /Problems/
-            # Additional sets of problems will be used when grading projects.
-            # You may also write your own problems.
-
-    r = open(os.path.join("Problems","ProblemSetList.txt"))    # ProblemSetList.txt lists the sets to solve.
-    line = getNextLine(r)                                   # Sets will be solved in the order they appear in the file.
-    while not line=="":                                     # You may modify ProblemSetList.txt for design and debugging.
-        sets.append(ProblemSet(line))                       # We will use a fresh copy of all problem sets when grading.
-        line=getNextLine(r)                                 # We will also use some problem sets not given in advance.
+def solve(workers=1, prefetch_depth=None):
+    # ProblemSetList.txt lists the sets to solve, in the order they are solved.
+    # You may modify ProblemSetList.txt for design and debugging.
+    # We will use a fresh copy of all problem sets when grading.
+    # We will also use some problem sets not given in advance.
 
     # Initializing problem-solving agent from Agent.java
     agent=Agent()   # Your agent will be initialized with its default constructor.
@@ -44,19 +90,36 @@ def solve():
                                                         # Note that each run of the program will overwrite the previous results.
                                                         # Do not write anything else to ProblemResults.txt during execution of the program.
         results.write("ProblemSet,RavensProblem,Agent's Answer\n")
-        for set in sets:
-            for problem in set.problems:   # Your agent will solve one problem at a time.
-                #try:
-                answer = agent.Solve(problem)  # The problem will be passed to your agent as a RavensProblem object as a parameter to the Solve method
-                                                # Your agent should return its answer at the conclusion of the execution of Solve.
-
-                results.write("%s,%s,%d\n" % (set.name, problem.name, answer))
-    r.close()
+        if workers > 1:
+            with Pool(workers, initializer=start_worker) as pool:
+                # The pool reads ahead, but a problem is only its figure names
+                # until a worker solves it
+                for row in pool.imap(solve_in_worker, stream_problems()):
+                    results.write(row)
+                    results.flush()
+        else:
+            # Your agent will solve one problem at a time, each passed to its
+            # Solve method as a RavensProblem object. iter_solve calls Solve on
+            # each problem in turn and yields its answer as soon as it is known.
+            for result in agent.iter_solve(stream_problems(), prefetch_depth):
+                results.write("%s,%s,%d\n" % (result.problem_set, result.problem, result.answer))
+                results.flush()
 
 # The main execution will have your agent generate answers for all the problems,
 # then generate the grades for them.
 def main():
-    solve()
+    parser = argparse.ArgumentParser(description='Solves and grades every problem set.')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes solving problems')
+    parser.add_argument('--prefetch', type=int, help='problems ahead whose figures are loaded in the background')
+    parser.add_argument('--clear-cache', action='store_true', help='empty the figure cache and exit')
+    args = parser.parse_args()
+
+    if args.clear_cache:
+        if figure_cache:
+            figure_cache.clear()
+        return
+
+    solve(args.workers, args.prefetch)
     grade()
 
 if __name__ == "__main__":
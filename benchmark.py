@@ -0,0 +1,142 @@
+# Times each stage of the agent over the problem sets in
+# Problems/ProblemSetList.txt.
+#
+# Every problem is solved as RavensProject.py would, with Agent.PROFILE set so
+# each Solve records the time of its stages. Stages nest, create_nodes includes
+# to_image_array and color_shapes and scoring includes get_net, so the times
+# of a stage include those of the stages inside it.
+#
+# The results are written as JSON and, given a saved baseline, compared
+# against it. A stage whose p50 or p95 grew by more than the threshold is a
+# regression and the run exits with status 1.
+
+import io
+import sys
+import json
+import argparse
+import contextlib
+from collections import defaultdict, Counter
+from time import perf_counter
+
+import numpy as np
+
+import Agent
+from RavensProject import problem_set_names, ProblemStream
+
+# Timers of Agent.SolveStats reported, in pipeline order
+STAGES = ["to_image_array", "color_shapes", "create_nodes", "Frame", "get_net", "scoring", "Solve"]
+
+# p50, p95, max and total of a list of times in seconds
+def summarize(times):
+    times = np.asarray(times, dtype=float)
+    if not len(times):
+        return {"p50": 0.0, "p95": 0.0, "max": 0.0, "total": 0.0}
+    return {"p50": float(np.percentile(times, 50)), "p95": float(np.percentile(times, 95)),
+            "max": float(times.max()), "total": float(times.sum())}
+
+# Solves every problem and returns the results as a dict ready for JSON.
+# With use_cache False the figure cache is bypassed, so every image is
+# decoded and labeled. prefetch is the number of problems whose figures are
+# loaded ahead in the background, see Agent.prefetch. With memory set the
+# peak memory of each problem is traced too, which slows every stage
+def run(use_cache=False, prefetch=0, memory=False):
+    figure_cache, profile, profile_memory = Agent.figure_cache, Agent.PROFILE, Agent.PROFILE_MEMORY
+    if not use_cache:
+        Agent.figure_cache = None
+    Agent.PROFILE = True
+    Agent.PROFILE_MEMORY = memory
+
+    agent = Agent.Agent()
+    per_set = {}
+    counters = Counter()
+    peaks = []
+    images = 0
+    start = perf_counter()
+    try:
+        for name in problem_set_names():
+            stages = defaultdict(list)
+            problems = ProblemStream(name)
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = agent.solve_batch(problems, prefetch)
+            for result in results:
+                for stage in STAGES:
+                    stages[stage].append(result.stats.seconds.get(stage, 0.0))
+                counters.update(result.stats.counters)
+                if result.peak_memory is not None:
+                    peaks.append(result.peak_memory)
+                images += result.stats.counters["figure cache hits"] + result.stats.counters["figure cache misses"]
+            per_set[name] = stages
+    finally:
+        Agent.figure_cache, Agent.PROFILE, Agent.PROFILE_MEMORY = figure_cache, profile, profile_memory
+    seconds = perf_counter() - start
+
+    return {
+        "problems": sum(len(i["Solve"]) for i in per_set.values()),
+        "images": images,
+        "seconds": seconds,
+        "images_per_second": images / seconds if seconds else 0.0,
+        "figure_cache": use_cache,
+        "prefetch": prefetch,
+        "stages": {stage: summarize([t for i in per_set.values() for t in i[stage]]) for stage in STAGES},
+        "sets": {name: {stage: summarize(stages[stage]) for stage in STAGES}
+                 for name, stages in per_set.items()},
+        "counters": {i: int(n) for i, n in counters.items()},
+        "peak_memory": {"p50": int(np.percentile(peaks, 50)), "max": int(max(peaks))} if peaks else None,
+    }
+
+# Stages whose p50 or p95 grew by more than threshold, as a fraction of the
+# baseline, and by at least min_delta seconds
+def regressions(results, baseline, threshold, min_delta):
+    found = []
+    for stage, summary in results["stages"].items():
+        if stage not in baseline.get("stages", {}):
+            continue
+        for statistic in ["p50", "p95"]:
+            old = baseline["stages"][stage][statistic]
+            new = summary[statistic]
+            if new - old >= min_delta and new > old * (1 + threshold):
+                found.append((stage, statistic, old, new))
+    return found
+
+def print_results(results):
+    print("%d problems, %d images in %.2fs, %.1f images per second" % (
+        results["problems"], results["images"], results["seconds"], results["images_per_second"]))
+    print("%-16s %10s %10s %10s %10s" % ("stage", "p50 ms", "p95 ms", "max ms", "total s"))
+    for stage, summary in results["stages"].items():
+        print("%-16s %10.2f %10.2f %10.2f %10.2f" % (stage, summary["p50"] * 1000, summary["p95"] * 1000,
+                                                     summary["max"] * 1000, summary["total"]))
+    if results["peak_memory"]:
+        print("peak memory per problem %.1f MB p50, %.1f MB max" % (
+            results["peak_memory"]["p50"] / 1e6, results["peak_memory"]["max"] / 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description='Times each stage of the agent over every problem set.')
+    parser.add_argument('--output', default='benchmark.json', help='file the results are written to')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='also write the results to the baseline file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='growth of a p50 or p95 counted as a regression')
+    parser.add_argument('--min-delta', type=float, default=0.001, help='seconds a stage must slow by to count')
+    parser.add_argument('--use-cache', action='store_true', help='load figures from the figure cache')
+    parser.add_argument('--prefetch', type=int, default=0, help='problems whose figures are loaded ahead')
+    parser.add_argument('--memory', action='store_true', help='also trace the peak memory of each problem')
+    args = parser.parse_args()
+
+    results = run(args.use_cache, args.prefetch, args.memory)
+    print_results(results)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.threshold, args.min_delta)
+        for stage, statistic, old, new in found:
+            print("Regression: %s %s %.2fms -> %.2fms" % (stage, statistic, old * 1000, new * 1000))
+        if found:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
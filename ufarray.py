@@ -6,7 +6,10 @@
 # It is used as part of the component labeling algorithm which I copied from
 # https://github.com/spwhitt/cclabel
 #
-# I made no modifications to this file
+# UFarray is unmodified, UFnumpy below was added for labeling whole batches of
+# equivalences at once
+
+import numpy as np
 
 
 # P: The array, which encodes the set membership of all the elements
@@ -68,4 +71,98 @@ class UFarray:
                 self.P[i] = self.P[self.P[i]]
             else:
                 self.P[i] = k
-                k += 1
\ No newline at end of file
+                k += 1
+
+
+# Union find kept in a numpy array
+# Unions are made a whole batch of pairs at a time and the final labels are
+# read back with a single flatten, so there is no python call per element
+
+class UFnumpy:
+    def __init__(self, capacity=64):
+        # Array which holds element -> parent, only the first self.label are used
+        self.P = np.arange(capacity, dtype=np.int32)
+
+        # Number of elements in each tree, only valid for roots
+        self.size = np.ones(capacity, dtype=np.int32)
+
+        # Name of the next label, when one is created
+        self.label = 0
+
+    # Makes room for at least n elements, doubling the arrays when full
+    def grow(self, n):
+        capacity = len(self.P)
+        if n <= capacity:
+            return
+        capacity = max(capacity, 1)
+        while capacity < n:
+            capacity *= 2
+        P = np.arange(capacity, dtype=np.int32)
+        P[:self.label] = self.P[:self.label]
+        size = np.ones(capacity, dtype=np.int32)
+        size[:self.label] = self.size[:self.label]
+        self.P = P
+        self.size = size
+
+    def makeLabel(self):
+        return int(self.makeLabels(1)[0])
+
+    # Creates n new labels at once and returns them
+    def makeLabels(self, n):
+        self.grow(self.label + n)
+        labels = np.arange(self.label, self.label + n, dtype=np.int32)
+        self.label += n
+        return labels
+
+    # Points every element straight at its root
+    def compress(self):
+        P = self.P[:self.label]
+        while True:
+            grand = P[P]
+            if np.array_equal(grand, P):
+                return
+            P[:] = grand
+
+    # Finds the roots of the trees containing the elements in i
+    def find(self, i):
+        self.compress()
+        return self.P[i]
+
+    # Joins the trees of a[k] and b[k] for every k
+    # The smaller tree is hung under the larger one, ties go to the lower label.
+    # When several unions want to move the same root only one of them lands,
+    # so repeat until every pair shares a root
+    def union_pairs(self, a, b):
+        a = np.asarray(a, dtype=np.int32)
+        b = np.asarray(b, dtype=np.int32)
+        while len(a):
+            self.compress()
+            ra = self.P[a]
+            rb = self.P[b]
+            split = ra != rb
+            a, b, ra, rb = a[split], b[split], ra[split], rb[split]
+            if not len(a):
+                return
+
+            a_wins = (self.size[ra] > self.size[rb]) | ((self.size[ra] == self.size[rb]) & (ra < rb))
+            winner = np.where(a_wins, ra, rb)
+            loser = np.where(a_wins, rb, ra)
+            self.P[loser] = winner
+
+            # Sizes of the trees that grew
+            self.compress()
+            roots = np.unique(self.P[winner])
+            self.size[roots] = np.bincount(self.P[:self.label], minlength=self.label)[roots]
+
+    def union(self, i, j):
+        self.union_pairs([i], [j])
+
+    # Returns the label of every element, numbered 1..n in order of the first
+    # element of each tree
+    def flatten(self):
+        self.compress()
+        roots = self.P[:self.label]
+        first = np.unique(roots, return_index=True)[1]
+        order = np.zeros(self.label, dtype=np.int32)
+        order[roots[np.sort(first)]] = np.arange(1, len(first) + 1, dtype=np.int32)
+        return order[roots]